@@ -9,6 +9,30 @@ import time
 import re # <-- Import the re module
 import argparse # <-- Import argparse
 import sys
+import hashlib
+import sqlite3
+import json
+import multiprocessing
+import pickle
+import shutil
+import tempfile
+from datetime import datetime
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+try:
+    import resource # POSIX only, used to cap the memory of extraction workers
+except ImportError:
+    resource = None
+try:
+    import win32api, win32job # pywin32 (see config.yaml), used to cap worker memory on Windows
+except ImportError:
+    win32api = win32job = None
+
+# Persistent cross-quiz question index, stored next to the script by default
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'question_index.sqlite')
+# Files that repeatedly failed extraction, skipped on later runs
+DEFAULT_QUARANTINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'quarantine.json')
 
 def sanitize_filename(name):
     """Removes or replaces characters invalid for filenames."""
@@ -73,28 +97,22 @@ def determine_correctness_from_grade(grade_text):
         print(f"Warning: Could not parse grade format: '{grade_text}'")
         return "Incorrect" # Treat format errors as Incorrect
 
-# --- Existing functions (extract_html_from_mhtml, extract_divs_from_html) remain the same ---
-# ... (keep extract_html_from_mhtml and extract_divs_from_html as they are) ...
-def extract_html_from_mhtml(mhtml_file):
+# --- MHTML extraction ---
+def load_mhtml_message(mhtml_file):
+    """Reads and parses an MHTML file into an email message. Read errors are raised."""
+    with open(mhtml_file, 'rb') as f:
+        return email.message_from_binary_file(f, policy=policy.default)
+
+def extract_html_from_message(msg, mhtml_file):
     """
     Extracts HTML body content string, images, header content string, and document title
-    from an MHTML file. Does NOT destructively modify the body content.
+    from an already parsed MHTML message. mhtml_file is only used in messages.
     """
     images = {}
     header_content_str = ""
     body_content_str = ""
     document_title = None # Initialize title
 
-    try:
-        with open(mhtml_file, 'rb') as f:
-            msg = email.message_from_binary_file(f, policy=policy.default)
-    except FileNotFoundError:
-        print(f"Error: MHTML file not found: {mhtml_file}")
-        return None, {}, "", None # Return None for body, empty dict, empty str, None title
-    except Exception as e:
-        print(f"Error reading MHTML file {mhtml_file}: {e}")
-        return None, {}, "", None
-
     for part in msg.iter_parts():
         content_type = part.get_content_type()
         if content_type == 'text/html':
@@ -102,6 +120,8 @@ def extract_html_from_mhtml(mhtml_file):
                 # Decode the primary HTML content
                 current_html_content = part.get_payload(decode=True).decode('utf-8', errors='ignore')
                 soup = BeautifulSoup(current_html_content, 'html.parser') # Parse once
+            except MemoryError:
+                raise # Let the extraction supervisor report it
             except Exception as e:
                 print(f"Error parsing HTML from {mhtml_file}: {e}")
                 continue # Skip this part if parsing fails
@@ -173,12 +193,356 @@ def extract_html_from_mhtml(mhtml_file):
     # Return the original body content string, images, header string, and extracted title
     return body_content_str, images, header_content_str, document_title
 
+def get_question_state(question):
+    """Returns the correctness state of a 'que' div based on its grade div."""
+    grade_div = question.find('div', class_='grade')
+    grade_text = grade_div.get_text(strip=True) if grade_div else ""
+    return determine_correctness_from_grade(grade_text)
+
 def extract_divs_from_html(html_content):
     """Extract divs with class 'que' from the HTML content."""
     soup = BeautifulSoup(html_content, 'html.parser')
     return soup.find_all('div', class_='que')
 
 
+def extract_completion_date(soup):
+    """
+    Returns the "Completed on" date of the attempt from the review summary table
+    as 'YYYY-MM-DD HH:MM:SS', or None if it is missing or in an unknown format.
+    """
+    for th in soup.find_all('th'):
+        if th.get_text(strip=True).lower() != 'completed on':
+            continue
+        td = th.find_next_sibling('td')
+        if not td:
+            return None
+        date_text = td.get_text(' ', strip=True)
+        for date_format in ('%A, %d %B %Y, %I:%M %p', '%A, %d %B %Y, %H:%M', '%d %B %Y, %I:%M %p', '%d %B %Y, %H:%M'):
+            try:
+                return datetime.strptime(date_text, date_format).strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                continue
+        return None
+    return None
+
+def extract_questions_from_mhtml(mhtml_file, include_css=False):
+    """
+    Extracts the question div HTML strings, images, header string, title, (if include_css)
+    the CSS and the attempt completion date from an MHTML file.
+    The CSS is None when not requested, the date None when not found.
+    Read errors are raised so callers can retry them.
+    """
+    msg = load_mhtml_message(mhtml_file)
+    body_content, images, header_content_str, document_title = extract_html_from_message(msg, mhtml_file)
+    soup = BeautifulSoup(body_content, 'html.parser')
+    question_html = [str(div) for div in soup.find_all('div', class_='que')]
+    css_content = extract_css_from_message(msg) if include_css else None
+    completed_on = extract_completion_date(soup)
+    return question_html, images, header_content_str, document_title, css_content, completed_on
+
+
+# --- Fault-isolated extraction ---
+_worker_job = None # Keeps the Windows job object alive for the lifetime of the worker
+
+def memory_limit_supported():
+    """Returns True if worker memory can be capped on this platform."""
+    return resource is not None or win32job is not None
+
+def _apply_memory_limit(memory_limit_mb):
+    """Caps the memory of the current (worker) process."""
+    global _worker_job
+    limit_bytes = memory_limit_mb * 1024 * 1024
+    if resource is not None:
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+        if hard_limit != resource.RLIM_INFINITY:
+            limit_bytes = min(limit_bytes, hard_limit)
+        resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, hard_limit))
+    elif win32job is not None:
+        _worker_job = win32job.CreateJobObject(None, '')
+        info = win32job.QueryInformationJobObject(_worker_job, win32job.JobObjectExtendedLimitInformation)
+        info['ProcessMemoryLimit'] = limit_bytes
+        info['BasicLimitInformation']['LimitFlags'] |= win32job.JOB_OBJECT_LIMIT_PROCESS_MEMORY
+        win32job.SetInformationJobObject(_worker_job, win32job.JobObjectExtendedLimitInformation, info)
+        win32job.AssignProcessToJobObject(_worker_job, win32api.GetCurrentProcess())
+
+def _extract_with_status(mhtml_file, include_css, memory_limit_mb):
+    """
+    Runs extract_questions_from_mhtml and returns ('ok', result) or ('error', kind, message),
+    kind being 'transient', 'memory' or 'fatal'.
+    """
+    try:
+        return ('ok', extract_questions_from_mhtml(mhtml_file, include_css))
+    except FileNotFoundError as e:
+        return ('error', 'fatal', str(e))
+    except OSError as e:
+        return ('error', 'transient', str(e))
+    except MemoryError:
+        return ('error', 'memory', f"exceeded the {memory_limit_mb} MB memory limit")
+    except Exception as e:
+        return ('error', 'fatal', f"{type(e).__name__}: {e}")
+
+def _extraction_worker(memory_limit_mb, request_conn, result_conn):
+    """
+    Long-lived worker process: receives (mhtml_file, include_css) requests until None or EOF
+    and sends back the _extract_with_status result of each.
+    If the memory limit cannot be applied, ('error', 'setup', message) is sent and the worker
+    exits; this says nothing about the file.
+    """
+    if memory_limit_mb:
+        try:
+            _apply_memory_limit(memory_limit_mb)
+        except Exception as e:
+            result_conn.send(('error', 'setup', f"{type(e).__name__}: {e}"))
+            result_conn.close()
+            return
+    try:
+        while True:
+            try:
+                request = request_conn.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+            mhtml_file, include_css = request
+            result_conn.send(_extract_with_status(mhtml_file, include_css, memory_limit_mb))
+    finally:
+        result_conn.close()
+
+class ExtractionSupervisor:
+    """
+    Extracts MHTML files in a worker process with a per-file timeout and memory limit,
+    retries transient read errors and quarantines files that keep failing across runs.
+    The worker is reused from file to file and only replaced after a timeout, crash or
+    memory error. Without any limit, files are extracted in-process.
+    Call close() when done to stop the worker.
+    """
+
+    def __init__(self, timeout=300, memory_limit_mb=2048, retries=2,
+                 quarantine_path=DEFAULT_QUARANTINE_PATH, quarantine_after=2):
+        # Spawned workers start with a fresh address space, so the memory limit
+        # only covers the file being extracted and not what the parent has accumulated
+        self._context = multiprocessing.get_context('spawn')
+        self.timeout = timeout if timeout and timeout > 0 else None
+        self.memory_limit_mb = memory_limit_mb
+        if memory_limit_mb and not memory_limit_supported():
+            print("Warning: Per-file memory limits are not supported on this platform (install pywin32 on Windows). "
+                  "Only the timeout will be enforced.")
+            self.memory_limit_mb = 0
+        self._process = None
+        self._request_conn = None
+        self._result_conn = None
+        self._worker_file_count = 0 # Files sent to the current worker
+        self.retries = retries
+        self.quarantine_path = quarantine_path
+        self.quarantine_after = quarantine_after
+        self.quarantine = self._load_quarantine()
+        self._quarantine_changed = False
+        self.skipped_files = [] # Quarantined files skipped in this run
+        self.failed_files = {}  # file -> reason, for files that failed in this run
+
+    def _load_quarantine(self):
+        if not self.quarantine_path or not os.path.exists(self.quarantine_path):
+            return {}
+        try:
+            with open(self.quarantine_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read quarantine list {self.quarantine_path}: {e}. Starting with an empty list.")
+            return {}
+
+    def save_quarantine(self):
+        """
+        Writes the quarantine list (failure counts and quarantined files) to disk if it changed.
+        The file is removed once no failures are left in it.
+        """
+        if not self.quarantine_path or not self._quarantine_changed:
+            return
+        try:
+            if self.quarantine:
+                with open(self.quarantine_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.quarantine, f, indent=2)
+            elif os.path.exists(self.quarantine_path):
+                os.remove(self.quarantine_path)
+            self._quarantine_changed = False
+        except OSError as e:
+            print(f"Warning: Could not save quarantine list {self.quarantine_path}: {e}")
+
+    def clear_quarantine(self):
+        """Forgets all recorded failures, so quarantined files are processed again."""
+        if self.quarantine:
+            self.quarantine = {}
+            self._quarantine_changed = True
+
+    @staticmethod
+    def _content_hash(mhtml_file):
+        try:
+            return file_content_hash(mhtml_file)
+        except OSError:
+            return None
+
+    def is_quarantined(self, mhtml_file):
+        """
+        Returns True if the file is quarantined. A file whose content changed since it was
+        quarantined (e.g. re-exported or fixed) is released automatically.
+        """
+        key = os.path.abspath(mhtml_file)
+        entry = self.quarantine.get(key)
+        if not (entry and entry.get('quarantined')):
+            return False
+        if self._content_hash(mhtml_file) != entry.get('sha256'):
+            print(f"Releasing {mhtml_file} from quarantine: its content changed.")
+            del self.quarantine[key]
+            self._quarantine_changed = True
+            return False
+        return True
+
+    def filter_quarantined(self, mhtml_files):
+        """Returns the files that are not quarantined, remembering the skipped ones for the summary."""
+        remaining = []
+        for mhtml_file in mhtml_files:
+            if self.is_quarantined(mhtml_file):
+                print(f"Skipping quarantined file: {mhtml_file}")
+                self.skipped_files.append(mhtml_file)
+            else:
+                remaining.append(mhtml_file)
+        return remaining
+
+    @property
+    def isolated(self):
+        """True if files are extracted in a worker process (a timeout or memory limit is set)."""
+        return bool(self.timeout or self.memory_limit_mb)
+
+    def _start_worker(self):
+        request_recv, self._request_conn = self._context.Pipe(duplex=False)
+        self._result_conn, result_send = self._context.Pipe(duplex=False)
+        self._process = self._context.Process(
+            target=_extraction_worker, args=(self.memory_limit_mb, request_recv, result_send), daemon=True
+        )
+        self._process.start()
+        # Only the worker uses these ends; closing them lets recv() see EOF if the worker dies
+        request_recv.close()
+        result_send.close()
+        self._worker_file_count = 0
+
+    def _stop_worker(self):
+        if self._process is None:
+            return
+        try:
+            self._request_conn.send(None)
+        except OSError:
+            pass # Worker already gone
+        self._process.join(1)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join(5)
+        self._request_conn.close()
+        self._result_conn.close()
+        self._process = self._request_conn = self._result_conn = None
+
+    def close(self):
+        """Stops the worker process, if one is running."""
+        self._stop_worker()
+
+    def _run_worker(self, mhtml_file, include_css):
+        """Runs one extraction attempt, in the worker process if isolated."""
+        if not self.isolated:
+            return _extract_with_status(mhtml_file, include_css, 0)
+
+        if self._process is None or not self._process.is_alive():
+            self._stop_worker()
+            self._start_worker()
+        try:
+            self._request_conn.send((mhtml_file, include_css))
+        except OSError:
+            # Worker died between requests: start a fresh one
+            self._stop_worker()
+            self._start_worker()
+            self._request_conn.send((mhtml_file, include_css))
+        self._worker_file_count += 1
+
+        if not self._result_conn.poll(self.timeout):
+            self._stop_worker() # Stuck on this file
+            return ('error', 'timeout', f"timed out after {self.timeout} seconds")
+        try:
+            result = self._result_conn.recv()
+        except EOFError:
+            self._process.join(5)
+            message = f"worker exited unexpectedly (exit code {self._process.exitcode})"
+            if self.memory_limit_mb:
+                message += f", possibly exceeding the {self.memory_limit_mb} MB memory limit"
+            self._stop_worker()
+            return ('error', 'crash', message)
+        if result[0] == 'error' and result[1] in ('memory', 'setup'):
+            self._stop_worker() # Its state cannot be trusted any more
+        return result
+
+    def extract(self, mhtml_file, include_css=False):
+        """
+        Returns the extract_questions_from_mhtml result for a file, or None if extraction failed.
+        A file that already failed in this run is not tried again.
+        """
+        if mhtml_file in self.failed_files:
+            return None
+
+        for attempt in range(self.retries + 1):
+            reused_worker = self._worker_file_count > 0
+            result = self._run_worker(mhtml_file, include_css)
+            if result[0] == 'error' and result[1] == 'setup':
+                # A broken limiting mechanism is not the file's fault: drop the limit and try again
+                print(f"Warning: Could not apply the per-file memory limit ({result[2]}). "
+                      "Continuing with only the timeout.")
+                self.memory_limit_mb = 0
+                result = self._run_worker(mhtml_file, include_css)
+            elif result[0] == 'error' and result[1] in ('memory', 'crash') and reused_worker:
+                # Memory left over from earlier files may be to blame: try once more in a fresh worker
+                print(f"Worker failed on {mhtml_file} ({result[2]}), retrying in a fresh worker...")
+                result = self._run_worker(mhtml_file, include_css)
+            if result[0] == 'ok':
+                if self.quarantine.pop(os.path.abspath(mhtml_file), None) is not None:
+                    self._quarantine_changed = True # Recovered, forget past failures
+                return result[1]
+            _, kind, message = result
+            if kind != 'transient' or attempt == self.retries:
+                break
+            print(f"Transient error reading {mhtml_file} ({message}), retrying ({attempt + 1}/{self.retries})...")
+            time.sleep(attempt + 1)
+
+        reason = f"{kind}: {message}"
+        print(f"Error extracting {mhtml_file}: {reason}")
+        self.failed_files[mhtml_file] = reason
+        self._record_failure(mhtml_file, reason)
+        return None
+
+    def _record_failure(self, mhtml_file, reason):
+        key = os.path.abspath(mhtml_file)
+        content_hash = self._content_hash(mhtml_file)
+        entry = self.quarantine.get(key)
+        if entry is None or entry.get('sha256') != content_hash:
+            # New file, or its content changed since the earlier failures: start counting again
+            entry = self.quarantine[key] = {'failures': 0, 'quarantined': False}
+        entry['sha256'] = content_hash
+        self._quarantine_changed = True
+        entry['failures'] += 1
+        entry['last_error'] = reason
+        entry['last_failed'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        if entry['failures'] >= self.quarantine_after and not entry['quarantined']:
+            entry['quarantined'] = True
+            print(f"Quarantining {mhtml_file} after {entry['failures']} failed runs; it will be skipped from now on.")
+
+    def print_summary(self):
+        """Prints the files skipped (quarantined) or failed in this run."""
+        if not self.skipped_files and not self.failed_files:
+            return
+        print("\n--- Skipped files summary ---")
+        for mhtml_file in self.skipped_files:
+            entry = self.quarantine.get(os.path.abspath(mhtml_file), {})
+            print(f"Quarantined (skipped): {mhtml_file} - last error: {entry.get('last_error', 'unknown')}")
+        for mhtml_file, reason in self.failed_files.items():
+            print(f"Failed: {mhtml_file} - {reason}")
+        if self.quarantine_path:
+            print(f"Quarantine list: {self.quarantine_path}")
+
+
 # --- Modified deduplicate function ---
 def deduplicate_and_replace_with_correct(questions_to_process, question_counts, total_files):
     """
@@ -196,87 +560,397 @@ def deduplicate_and_replace_with_correct(questions_to_process, question_counts,
 
         question_text = question_text_div.get_text(strip=True)
 
-        # Find the grade div and extract its text
-        grade_div = question.find('div', class_='grade')
-        grade_text = grade_div.get_text(strip=True) if grade_div else ""
-
         # Determine the state based on the grade text
-        calculated_state = determine_correctness_from_grade(grade_text)
+        calculated_state = get_question_state(question)
 
         # Retrieve the total count for this question text
         # Use .get for safety, although the text should exist if it came from the initial count
         current_count = question_counts.get(question_text, 0)
 
-        # --- Deduplication Logic based on calculated_state ---
-        if question_text in question_map:
-            # A version of this question already exists
-            existing_entry = question_map[question_text]
-            existing_state = existing_entry['state']
-
-            # Define state priorities
-            state_priority = {"Correct": 3, "Partially Correct": 2, "Incorrect": 1}
-            current_priority = state_priority.get(calculated_state, 0)
-            existing_priority = state_priority.get(existing_state, 0)
-
-            # Replace if the current question's state is better
-            if current_priority > existing_priority:
-                # Store the best div, its state, and the total count
-                question_map[question_text] = {
-                    'question': question,
-                    'state': calculated_state,
-                    'count': current_count # Count remains the same for this question text
-                }
-                # print(f"Replacing '{existing_state}' with '{calculated_state}' for question: {question_text[:50]}...") # Optional debug
+        merge_best_question(question_map, question_text, question, calculated_state, current_count)
 
-        else:
-            # If the question is new, add it with its count
+    # Return the list of enriched dictionaries (values from the map)
+    return list(question_map.values())
+
+def merge_best_question(question_map, question_text, question, calculated_state, current_count):
+    """
+    Adds one question to question_map, replacing the stored version only if the new state is better.
+    question_map can be a dict or a disk-backed SpillDict (which then stores the question as HTML).
+    """
+    # --- Deduplication Logic based on calculated_state ---
+    if question_text in question_map:
+        # A version of this question already exists
+        existing_entry = question_map[question_text]
+        existing_state = existing_entry['state']
+
+        # Define state priorities
+        state_priority = {"Correct": 3, "Partially Correct": 2, "Incorrect": 1}
+        current_priority = state_priority.get(calculated_state, 0)
+        existing_priority = state_priority.get(existing_state, 0)
+
+        # Replace if the current question's state is better
+        if current_priority > existing_priority:
+            # Store the best div, its state, and the total count
             question_map[question_text] = {
                 'question': question,
                 'state': calculated_state,
-                'count': current_count
+                'count': current_count # Count remains the same for this question text
             }
+            # print(f"Replacing '{existing_state}' with '{calculated_state}' for question: {question_text[:50]}...") # Optional debug
 
-    # Return the list of enriched dictionaries (values from the map)
-    return list(question_map.values())
+    else:
+        # If the question is new, add it with its count
+        question_map[question_text] = {
+            'question': question,
+            'state': calculated_state,
+            'count': current_count
+        }
+
+
+# --- Disk-backed storage for memory-bounded mode (--max-memory) ---
+class SpillDict(MutableMapping):
+    """
+    Dictionary stored in a SQLite table, keeping recently used entries in an in-memory LRU cache
+    of at most max_bytes. Iteration follows first insertion order, like a dict.
+    Entries must not be added or removed while iterating.
+    """
+
+    # Measured Python overhead of a cached entry besides its key and blob:
+    # the [blob, dirty, seq] list, the seq int and the OrderedDict node
+    ENTRY_OVERHEAD_BYTES = 224
+
+    @classmethod
+    def _entry_size(cls, key, blob):
+        return sys.getsizeof(key) + sys.getsizeof(blob) + cls.ENTRY_OVERHEAD_BYTES
+
+    def __init__(self, conn, table, max_bytes):
+        self._conn = conn
+        self._table = table
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict() # key -> [pickled value, dirty, insertion sequence]
+        self._cache_bytes = 0
+        self._length = 0
+        self._next_seq = 0
+        conn.execute(f"CREATE TABLE {table} (key TEXT PRIMARY KEY, seq INTEGER NOT NULL, value BLOB NOT NULL)")
+        conn.execute(f"CREATE INDEX idx_{table}_seq ON {table} (seq)")
+
+    def _lookup(self, key):
+        """Returns the cache entry for key, loading it from disk if needed, or None."""
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+            return entry
+        row = self._conn.execute(f"SELECT value, seq FROM {self._table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        entry = [row[0], False, row[1]]
+        self._cache[key] = entry
+        self._cache_bytes += self._entry_size(key, entry[0])
+        self._evict()
+        return entry
+
+    def _write(self, key, entry):
+        self._conn.execute(
+            f"INSERT INTO {self._table} (key, seq, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, entry[2], entry[0])
+        )
+        entry[1] = False
+
+    def _evict(self):
+        """Spills the least recently used entries to disk until the cache fits in max_bytes."""
+        while self._cache_bytes > self.max_bytes and len(self._cache) > 1:
+            key, entry = self._cache.popitem(last=False)
+            if entry[1]:
+                self._write(key, entry)
+            self._cache_bytes -= self._entry_size(key, entry[0])
+
+    def flush(self):
+        """Writes all modified cached entries to disk."""
+        for key, entry in self._cache.items():
+            if entry[1]:
+                self._write(key, entry)
+        self._conn.commit()
+
+    def __getitem__(self, key):
+        entry = self._lookup(key)
+        if entry is None:
+            raise KeyError(key)
+        return pickle.loads(entry[0])
+
+    def __setitem__(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        entry = self._lookup(key)
+        if entry is None:
+            entry = [blob, True, self._next_seq]
+            self._next_seq += 1
+            self._length += 1
+            self._cache[key] = entry
+            self._cache_bytes += self._entry_size(key, blob)
+        else:
+            self._cache_bytes += sys.getsizeof(blob) - sys.getsizeof(entry[0])
+            entry[0] = blob
+            entry[1] = True
+        self._evict()
+
+    def __delitem__(self, key):
+        if self._lookup(key) is None:
+            raise KeyError(key)
+        entry = self._cache.pop(key)
+        self._cache_bytes -= self._entry_size(key, entry[0])
+        self._conn.execute(f"DELETE FROM {self._table} WHERE key = ?", (key,))
+        self._length -= 1
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def items(self):
+        """Yields (key, value) pairs in insertion order, streaming them from disk."""
+        self.flush()
+        for key, blob in self._conn.execute(f"SELECT key, value FROM {self._table} ORDER BY seq"):
+            yield key, pickle.loads(blob)
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+class SpillDatabase:
+    """Temporary SQLite database holding the SpillDicts of one run. Deleted on close()."""
+
+    def __init__(self, spill_dir=None):
+        self.directory = tempfile.mkdtemp(prefix='moodle_quiz_spill_', dir=spill_dir)
+        self.conn = sqlite3.connect(os.path.join(self.directory, 'spill.sqlite'))
+        # Throwaway data: no need for crash safety
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+
+    def create_dict(self, name, max_bytes):
+        return SpillDict(self.conn, name, max_bytes)
+
+    def close(self):
+        self.conn.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def iter_spilled_questions(question_map, question_counts):
+    """
+    Yields the entries of a disk-backed question_map in order, with the stored HTML
+    parsed back into a tag and the final count looked up in question_counts.
+    """
+    for question_text, entry in question_map.items():
+        entry['question'] = BeautifulSoup(entry['question'], 'html.parser').find('div', class_='que')
+        entry['count'] = question_counts.get(question_text, 0)
+        yield entry
+
+
+# --- Persistent question index ---
+def normalize_question_text(question_text):
+    """Normalizes question text (whitespace and case) so trivial differences hash the same."""
+    return ' '.join(question_text.split()).casefold()
+
+def question_hash(question_text):
+    """Returns the hash used as the index key for a question text."""
+    return hashlib.sha1(normalize_question_text(question_text).encode('utf-8')).hexdigest()
+
+def file_content_hash(file_path):
+    """Returns the SHA-256 of a file's content, used to avoid indexing the same attempt twice."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def open_question_index(index_path):
+    """Opens (and creates if needed) the SQLite question index."""
+    conn = sqlite3.connect(index_path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS questions (
+            qhash TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            first_seen TEXT NOT NULL,
+            last_seen TEXT NOT NULL,
+            occurrences INTEGER NOT NULL DEFAULT 0,
+            correct_count INTEGER NOT NULL DEFAULT 0,
+            partial_count INTEGER NOT NULL DEFAULT 0,
+            incorrect_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS question_quizzes (
+            qhash TEXT NOT NULL,
+            quiz TEXT NOT NULL,
+            PRIMARY KEY (qhash, quiz)
+        );
+        CREATE TABLE IF NOT EXISTS indexed_files (
+            file_hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            quiz TEXT NOT NULL,
+            indexed_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_questions_occurrences ON questions (occurrences);
+        CREATE INDEX IF NOT EXISTS idx_questions_correct ON questions (correct_count, occurrences);
+    """)
+    return conn
+
+def record_file_in_index(conn, mhtml_file, quiz_title, occurrences, attempt_date=None):
+    """
+    Adds the questions of one MHTML file to the index.
+    occurrences is a list of (question_text, state) tuples.
+    attempt_date ('YYYY-MM-DD HH:MM:SS', usually the "Completed on" date) is used for
+    first/last seen; the file's modification time is used if it is not known.
+    Returns False if the file's content was already indexed by a previous run.
+    """
+    file_hash = file_content_hash(mhtml_file)
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    seen = attempt_date or time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(mhtml_file)))
+    # All rows of one file go in together, so a failure never leaves it half indexed
+    conn.execute("SAVEPOINT index_file")
+    try:
+        try:
+            conn.execute(
+                "INSERT INTO indexed_files (file_hash, path, quiz, indexed_at) VALUES (?, ?, ?, ?)",
+                (file_hash, os.path.abspath(mhtml_file), quiz_title, now)
+            )
+        except sqlite3.IntegrityError:
+            conn.execute("RELEASE SAVEPOINT index_file")
+            return False # Same attempt already indexed (possibly under another path)
+
+        state_columns = {"Correct": "correct_count", "Partially Correct": "partial_count", "Incorrect": "incorrect_count"}
+        for question_text, state in occurrences:
+            qhash = question_hash(question_text)
+            state_column = state_columns.get(state, "incorrect_count")
+            conn.execute(
+                f"""INSERT INTO questions (qhash, text, first_seen, last_seen, occurrences, {state_column})
+                    VALUES (?, ?, ?, ?, 1, 1)
+                    ON CONFLICT(qhash) DO UPDATE SET
+                        first_seen = MIN(first_seen, excluded.first_seen),
+                        last_seen = MAX(last_seen, excluded.last_seen),
+                        occurrences = occurrences + 1,
+                        {state_column} = {state_column} + 1""",
+                (qhash, question_text, seen, seen)
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO question_quizzes (qhash, quiz) VALUES (?, ?)",
+                (qhash, quiz_title)
+            )
+    except sqlite3.Error:
+        conn.execute("ROLLBACK TO SAVEPOINT index_file")
+        conn.execute("RELEASE SAVEPOINT index_file")
+        raise
+    conn.execute("RELEASE SAVEPOINT index_file")
+    return True
+
+def query_question_index(index_path, query, limit):
+    """
+    Runs one of the predefined queries against the question index.
+    'top' returns the most frequent questions, 'never-correct' those never answered correctly.
+    """
+    where_clause = "WHERE q.correct_count = 0" if query == 'never-correct' else ""
+    conn = open_question_index(index_path)
+    try:
+        rows = conn.execute(
+            f"""SELECT q.text, q.occurrences, q.correct_count, q.partial_count, q.incorrect_count,
+                       q.first_seen, q.last_seen,
+                       (SELECT GROUP_CONCAT(qq.quiz, '; ') FROM question_quizzes qq WHERE qq.qhash = q.qhash)
+                FROM questions q {where_clause}
+                ORDER BY q.occurrences DESC, q.last_seen DESC
+                LIMIT ?""",
+            (limit,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return rows
+
+def print_query_results(rows):
+    """Prints rows returned by query_question_index."""
+    if not rows:
+        print("No matching questions in the index.")
+        return
+    for rank, (text, occurrences, correct, partial, incorrect, first_seen, last_seen, quizzes) in enumerate(rows, 1):
+        short_text = text if len(text) <= 100 else text[:97] + '...'
+        print(f"{rank:>3}. [{occurrences}x | C:{correct} P:{partial} I:{incorrect}] {short_text}")
+        print(f"     Attempts from {first_seen} to {last_seen} in: {quizzes or '-'}")
 
 # --- consolidate_mhtml_files function ---
-def consolidate_mhtml_files(mhtml_files, output_html_file, first_file_header_str=""):
+def consolidate_mhtml_files(mhtml_files, output_html_file, first_file_header_str="", index_path=None, supervisor=None,
+                            max_memory_mb=None, spill_dir=None, first_file_result=None):
     """
     Consolidates divs with class 'que' from multiple MHTML files into one HTML document,
     including question frequency information.
     Uses the provided header string from the first file.
+    If index_path is given, every processed file is also recorded in the persistent question index.
+    If an ExtractionSupervisor is given, each file is extracted in an isolated worker process.
+    If max_memory_mb is given, the question map, counts and images are kept in a temporary
+    on-disk store (in spill_dir) with at most that much cached in memory.
+    first_file_result can hold (mhtml_file, result) from an extraction done with include_css=True
+    (e.g. for the header), so that file is not extracted again.
+    Returns True if the consolidated document was written.
     """
-    html_title = os.path.splitext(os.path.basename(output_html_file))[0].replace('_', ' ')
-    consolidated_html = f'<html><head><meta charset="UTF-8"><title>{html_title}</title>'
-
-    # Extract CSS from the first MHTML file
-    if mhtml_files:
-        first_mhtml_file = mhtml_files[0]
-        css_content = extract_css_from_mhtml(first_mhtml_file)
-        if css_content:
-            # Add a basic style for the frequency display
-            css_content += "\n.question-frequency { font-size: 0.85em; color: #444; margin-left: 15px; display: inline-block; vertical-align: middle; }"
-            consolidated_html += f'<style>{css_content}</style>'
-
-    if first_file_header_str:
-        consolidated_html += f'{first_file_header_str}'
-
-    consolidated_html += '</head><body><section>' # Start the main content section
+    if not max_memory_mb:
+        return _consolidate_into_html(mhtml_files, output_html_file, first_file_header_str, index_path, supervisor,
+                                      first_file_result, question_counts={}, all_images={}, question_map=None)
 
+    spill = SpillDatabase(spill_dir)
+    try:
+        budget_bytes = max_memory_mb * 1024 * 1024 // 3 # Shared equally by the three structures
+        return _consolidate_into_html(mhtml_files, output_html_file, first_file_header_str, index_path, supervisor,
+                                      first_file_result,
+                                      question_counts=spill.create_dict('question_counts', budget_bytes),
+                                      all_images=spill.create_dict('images', budget_bytes),
+                                      question_map=spill.create_dict('question_map', budget_bytes))
+    except sqlite3.Error as e:
+        print(f"Error: The on-disk store in {spill.directory} failed: {e}. "
+              f"Aborting; {output_html_file} was not written.")
+        return False
+    finally:
+        spill.close()
+
+def _consolidate_into_html(mhtml_files, output_html_file, first_file_header_str, index_path, supervisor,
+                           first_file_result, question_counts, all_images, question_map):
+    """
+    Does the work of consolidate_mhtml_files. If question_map is None, questions are deduplicated
+    in memory after all files are read; otherwise they are merged into it (as HTML) file by file.
+    Returns True if the consolidated document was written.
+    """
     question_number = 1
-    all_images = {}
-    questions_to_process = [] # List to hold all raw question divs
-    question_counts = {}      # Dictionary to count occurrences of each question text
+    css_content = None        # CSS of the first successfully extracted file
+    questions_to_process = [] # List to hold all raw question divs (in-memory mode only)
+    total_question_count = 0  # Number of raw question divs found
     processed_file_count = 0  # Count successfully processed files
 
+    index_conn = None
+    if index_path:
+        try:
+            index_conn = open_question_index(index_path)
+        except sqlite3.Error as e:
+            print(f"Warning: Could not open question index {index_path}: {e}. Index will not be updated.")
+    newly_indexed_count = 0
+
     # --- First Pass: Gather all questions, images, and counts ---
     for mhtml_file in mhtml_files:
         print(f'Processing {mhtml_file}...')
-        body_content, images, _, _ = extract_html_from_mhtml(mhtml_file)
+        if first_file_result and mhtml_file == first_file_result[0]:
+            extracted = first_file_result[1] # Already extracted for the header
+            first_file_result = None
+        elif supervisor:
+            extracted = supervisor.extract(mhtml_file, include_css=css_content is None)
+        else:
+            try:
+                extracted = extract_questions_from_mhtml(mhtml_file, include_css=css_content is None)
+            except Exception as e:
+                print(f"Error reading MHTML file {mhtml_file}: {e}")
+                extracted = None
 
-        if body_content is None:
+        if extracted is None:
             print(f"Skipping file due to extraction error: {mhtml_file}")
             continue
+        question_html, images, _, quiz_title, file_css, completed_on = extracted
+        if css_content is None:
+            css_content = file_css or ""
 
         # Merge images
         for loc, data in images.items():
@@ -285,7 +959,7 @@ def consolidate_mhtml_files(mhtml_files, output_html_file, first_file_header_str
 
         # Parse body and count questions
         try:
-            soup = BeautifulSoup(body_content, 'html.parser')
+            soup = BeautifulSoup(''.join(question_html), 'html.parser')
             found_questions = soup.find_all('div', class_='que')
             if not found_questions:
                  print(f"Warning: No '<div class=\"que\">' elements found in the body of {mhtml_file}")
@@ -294,99 +968,147 @@ def consolidate_mhtml_files(mhtml_files, output_html_file, first_file_header_str
                  continue # Skip to next file if no questions found
 
             file_had_questions = False
+            index_occurrences = [] # (question_text, state) pairs for the question index
             for div in found_questions:
-                questions_to_process.append(div) # Add raw div
+                total_question_count += 1
+                if question_map is None:
+                    questions_to_process.append(div) # Add raw div
                 # Count based on question text
                 qtext_div = div.find('div', class_='qtext')
                 if qtext_div:
                     q_text = qtext_div.get_text(strip=True)
                     question_counts[q_text] = question_counts.get(q_text, 0) + 1
                     file_had_questions = True
+                    if index_conn or question_map is not None:
+                        state = get_question_state(div)
+                    if index_conn:
+                        index_occurrences.append((q_text, state))
+                    if question_map is not None:
+                        # Merge right away so raw divs are not kept; the final count is looked up at output time
+                        merge_best_question(question_map, q_text, str(div), state, 0)
                 else:
                     print("Warning: Found 'que' div without 'qtext' while counting.")
 
             if file_had_questions: # Increment count only if questions were found and processed
                 processed_file_count += 1
-
+                if index_conn:
+                    quiz_name = quiz_title or os.path.splitext(os.path.basename(mhtml_file))[0]
+                    try:
+                        if record_file_in_index(index_conn, mhtml_file, quiz_name, index_occurrences, completed_on):
+                            newly_indexed_count += 1
+                    except (OSError, sqlite3.Error) as e:
+                        print(f"Warning: Could not add {mhtml_file} to the question index: {e}")
+
+        except sqlite3.Error:
+            raise # On-disk store failure (--max-memory): dropping the file would silently change the output
         except Exception as e:
             print(f"Error parsing body content or finding questions in {mhtml_file}: {e}")
             # Do not increment processed_file_count if parsing failed
             continue
 
-    print(f"Found {len(questions_to_process)} question divs in total across {processed_file_count} successfully processed files.")
+    print(f"Found {total_question_count} question divs in total across {processed_file_count} successfully processed files.")
     print(f"Identified {len(question_counts)} unique question texts.")
 
+    if index_conn:
+        try:
+            index_conn.commit()
+            print(f"Question index updated with {newly_indexed_count} new file(s): {index_path}")
+        except sqlite3.Error as e:
+            print(f"Warning: Could not save question index {index_path}: {e}")
+        finally:
+            index_conn.close()
+
     # --- Deduplicate and prioritize ---
     # Pass the raw questions, the counts, and the total number of files processed
     if processed_file_count == 0:
         print("Warning: No files were successfully processed. Output will be empty.")
         final_question_data = []
-    else:
+    elif question_map is None:
         final_question_data = deduplicate_and_replace_with_correct(
             questions_to_process, question_counts, processed_file_count
         )
-    print(f"Processing {len(final_question_data)} unique/best questions for output.")
+    else:
+        final_question_data = iter_spilled_questions(question_map, question_counts)
+    unique_question_count = len(final_question_data) if question_map is None else len(question_map)
+    print(f"Processing {unique_question_count} unique/best questions for output.")
 
-    # --- Second Pass: Process the final list, renumber, embed images, add frequency ---
-    for item in final_question_data:
-        question = item['question'] # The BeautifulSoup tag for the question div
-        count = item['count']       # The frequency count for this question
-
-        # Calculate frequency percentage
-        frequency_percent = (count / processed_file_count) * 100 if processed_file_count > 0 else 0
-
-        # --- Inject Frequency Information ---
-        info_div = question.find('div', class_='info')
-        if info_div:
-            # Create the frequency span
-            freq_span = BeautifulSoup(f'<span class="question-frequency">Frequency: {count}/{processed_file_count} ({frequency_percent:.1f}%)</span>', 'html.parser').span
-            # Append it within the info div (e.g., after the number)
-            info_div.append(freq_span)
-        else:
-            print("Warning: 'info' div not found in a question. Cannot add frequency info directly.")
-            # Optionally, add it elsewhere as a fallback
-
-        # --- Renumber question ---
-        qno_span = question.find('span', class_=re.compile(r'qno'))
-        if qno_span:
-            num_element = qno_span.find(string=re.compile(r'\d+'))
-            if num_element:
-                 num_element.replace_with(str(question_number))
-            else:
-                 qno_span.string = str(question_number) # Fallback
-            question_number += 1
-        else:
-             print(f"Warning: Question number span ('qno') not found in a question div.")
+    html_title = os.path.splitext(os.path.basename(output_html_file))[0].replace('_', ' ')
+    consolidated_html = f'<html><head><meta charset="UTF-8"><title>{html_title}</title>'
 
-        # --- Embed images ---
-        for img in question.find_all('img'):
-            img_src = img.get('src', '')
-            if img_src in all_images:
-                image_base64, mime_type = all_images[img_src]
-                img['src'] = f"data:image/{mime_type};base64,{image_base64}"
+    # Use the CSS extracted from the first usable MHTML file
+    if css_content:
+        # Add a basic style for the frequency display
+        css_content += "\n.question-frequency { font-size: 0.85em; color: #444; margin-left: 15px; display: inline-block; vertical-align: middle; }"
+        consolidated_html += f'<style>{css_content}</style>'
 
-        # Add the modified question HTML to the consolidated output
-        consolidated_html += str(question)
+    if first_file_header_str:
+        consolidated_html += f'{first_file_header_str}'
 
-    consolidated_html += '</section></body></html>'
+    consolidated_html += '</head><body><section>' # Start the main content section
 
-    # Save the consolidated HTML
+    # --- Second Pass: Process the final list, renumber, embed images, add frequency ---
+    # Questions are written as they are processed, so the whole document is never held in memory.
+    # They go to a temporary file first so a failure never leaves a truncated output behind.
+    temp_output_file = f"{output_html_file}.part"
     try:
-        with open(output_html_file, 'w', encoding='utf-8') as f:
-            f.write(consolidated_html)
+        with open(temp_output_file, 'w', encoding='utf-8') as output:
+            output.write(consolidated_html)
+            for item in final_question_data:
+                question = item['question'] # The BeautifulSoup tag for the question div
+                count = item['count']       # The frequency count for this question
+
+                # Calculate frequency percentage
+                frequency_percent = (count / processed_file_count) * 100 if processed_file_count > 0 else 0
+
+                # --- Inject Frequency Information ---
+                info_div = question.find('div', class_='info')
+                if info_div:
+                    # Create the frequency span
+                    freq_span = BeautifulSoup(f'<span class="question-frequency">Frequency: {count}/{processed_file_count} ({frequency_percent:.1f}%)</span>', 'html.parser').span
+                    # Append it within the info div (e.g., after the number)
+                    info_div.append(freq_span)
+                else:
+                    print("Warning: 'info' div not found in a question. Cannot add frequency info directly.")
+                    # Optionally, add it elsewhere as a fallback
+
+                # --- Renumber question ---
+                qno_span = question.find('span', class_=re.compile(r'qno'))
+                if qno_span:
+                    num_element = qno_span.find(string=re.compile(r'\d+'))
+                    if num_element:
+                         num_element.replace_with(str(question_number))
+                    else:
+                         qno_span.string = str(question_number) # Fallback
+                    question_number += 1
+                else:
+                     print(f"Warning: Question number span ('qno') not found in a question div.")
+
+                # --- Embed images ---
+                for img in question.find_all('img'):
+                    img_src = img.get('src', '')
+                    if img_src in all_images:
+                        image_base64, mime_type = all_images[img_src]
+                        img['src'] = f"data:image/{mime_type};base64,{image_base64}"
+
+                # Add the modified question HTML to the consolidated output
+                output.write(str(question))
+
+            output.write('</section></body></html>')
+        os.replace(temp_output_file, output_html_file)
         print(f'Consolidated document saved as {output_html_file}')
+        return True
     except Exception as e:
         print(f"Error writing consolidated HTML file {output_html_file}: {e}")
+        try:
+            os.remove(temp_output_file)
+        except OSError:
+            pass
+        return False
 
 
 
-# --- Other functions (extract_css_from_mhtml, convert_html_to_pdf, find_wkhtmltopdf) remain the same ---
-# ... (keep extract_css_from_mhtml, convert_html_to_pdf, find_wkhtmltopdf as they are) ...
-def extract_css_from_mhtml(mhtml_file):
-    """Extract CSS content (both internal and external) from the first MHTML file."""
-    with open(mhtml_file, 'rb') as f:
-        msg = email.message_from_binary_file(f, policy=policy.default)
-
+def extract_css_from_message(msg):
+    """Extract CSS content (both internal and external) from a parsed MHTML message."""
     css_content = ""
 
     # Look for the CSS part in the MHTML file (internal CSS)
@@ -585,9 +1307,93 @@ if __name__ == '__main__':
         default=None, # Default is None, meaning we extract from header
         help='Specify a custom base name for the output files (overrides header extraction)'
     )
+    parser.add_argument(
+        '--index',
+        type=str,
+        default=DEFAULT_INDEX_PATH,
+        help='Path to the persistent question index database (defaults to question_index.sqlite next to the script)'
+    )
+    parser.add_argument(
+        '--no-index',
+        action='store_true',
+        help='Do not record the processed files in the question index'
+    )
+    parser.add_argument(
+        '-q', '--query',
+        choices=['top', 'never-correct'],
+        default=None,
+        help='Query the question index instead of aggregating: "top" lists the most frequent questions, '
+             '"never-correct" those never answered correctly'
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=20,
+        help='Number of questions to list with --query (default: 20)'
+    )
+    parser.add_argument(
+        '--file-timeout',
+        type=float,
+        default=300,
+        help='Maximum seconds to spend extracting a single MHTML file, 0 to disable (default: 300)'
+    )
+    parser.add_argument(
+        '--file-memory',
+        type=int,
+        default=2048,
+        help='Maximum memory in MB for extracting a single MHTML file, 0 to disable (default: 2048)'
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=2,
+        help='Number of retries for transient read errors per file (default: 2)'
+    )
+    parser.add_argument(
+        '--quarantine',
+        type=str,
+        default=DEFAULT_QUARANTINE_PATH,
+        help='Path to the quarantine list of repeatedly failing files (defaults to quarantine.json next to the script)'
+    )
+    parser.add_argument(
+        '--quarantine-after',
+        type=int,
+        default=2,
+        help='Number of failed runs after which a file is quarantined and skipped (default: 2)'
+    )
+    parser.add_argument(
+        '--max-memory',
+        type=int,
+        default=None,
+        help='Memory-bounded mode: keep the question map, counts and images on disk, caching at most this many MB '
+             'of them in memory (for very large archives). Parsing each file comes on top of this'
+    )
+    parser.add_argument(
+        '--spill-dir',
+        type=str,
+        default=None,
+        help='Directory for the temporary on-disk store used with --max-memory (defaults to the system temp folder)'
+    )
+    parser.add_argument(
+        '--clear-quarantine',
+        action='store_true',
+        help='Forget all recorded failures and process quarantined files again'
+    )
 
     args = parser.parse_args()
 
+    # --- Query Mode: answer from the index without parsing any MHTML ---
+    if args.query:
+        if not os.path.isfile(args.index):
+            print(f"Error: Question index not found: {args.index}")
+            sys.exit(1)
+        try:
+            print_query_results(query_question_index(args.index, args.query, args.limit))
+        except sqlite3.Error as e:
+            print(f"Error querying question index {args.index}: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
     # --- Validate Folder Path ---
     mhtml_folder = args.mhtml_folder_arg
     if not os.path.exists(mhtml_folder):
@@ -626,13 +1432,37 @@ if __name__ == '__main__':
         sys.exit(1)
 
 
+    # --- Set up fault-isolated extraction and skip quarantined files ---
+    supervisor = ExtractionSupervisor(
+        timeout=args.file_timeout,
+        memory_limit_mb=args.file_memory,
+        retries=args.retries,
+        quarantine_path=args.quarantine,
+        quarantine_after=args.quarantine_after
+    )
+    if args.clear_quarantine:
+        print("Clearing the quarantine list.")
+        supervisor.clear_quarantine()
+    found_file_count = len(mhtml_files)
+    mhtml_files = supervisor.filter_quarantined(mhtml_files)
+
     # --- Check if files were found and proceed ---
-    if not mhtml_files:
+    if not mhtml_files and found_file_count:
+        print(f"All {found_file_count} .mhtml file(s) found in '{mhtml_folder}' are quarantined. "
+              "Use --clear-quarantine to process them again.")
+    elif not mhtml_files:
         print(f"No .mhtml files found in '{mhtml_folder}'" + (" or its subfolders." if args.recursive else "."))
     else:
-        # --- Extract Header String and potentially Title from the first file ---
-        print(f"Extracting header structure from first file: {mhtml_files[0]}")
-        _, _, first_header_str, extracted_title = extract_html_from_mhtml(mhtml_files[0]) # Assumes this function exists
+        # --- Extract Header String and potentially Title from the first usable file ---
+        first_header_str, extracted_title = "", None
+        first_file_result = None # Reused by the consolidation instead of extracting the file again
+        for candidate_file in mhtml_files:
+            print(f"Extracting header structure from first file: {candidate_file}")
+            extracted = supervisor.extract(candidate_file, include_css=True)
+            if extracted is not None:
+                _, _, first_header_str, extracted_title, _, _ = extracted
+                first_file_result = (candidate_file, extracted)
+                break
 
         # --- Determine Base Filename (Custom or Extracted) ---
         if args.name:
@@ -688,10 +1518,16 @@ if __name__ == '__main__':
         # --- Consolidate the files ---
         # Pass the list of files, the dynamic output HTML name (now with full path),
         # and the MODIFIED header string
-        consolidate_mhtml_files(mhtml_files, output_file, modified_header_str) # Assumes this function exists
+        index_path = None if args.no_index else args.index
+        if args.max_memory:
+            print(f"Memory-bounded mode: caching at most {args.max_memory} MB of question data in memory.")
+        consolidated = consolidate_mhtml_files(mhtml_files, output_file, modified_header_str, index_path, supervisor,
+                                               args.max_memory, args.spill_dir, first_file_result) # Assumes this function exists
 
         # --- Conditional PDF Conversion ---
-        if args.pdf:
+        if args.pdf and not consolidated:
+            print("\nSkipping PDF generation because the consolidated HTML was not written.")
+        elif args.pdf:
             print("\nAttempting PDF conversion...")
             try:
                 # Pass the full paths for both input HTML and output PDF
@@ -701,4 +1537,9 @@ if __name__ == '__main__':
         else:
             print("\nSkipping PDF generation (use -p or --pdf option to enable).")
 
+    # --- Persist failures and report skipped files ---
+    supervisor.close()
+    supervisor.save_quarantine()
+    supervisor.print_summary()
+
 # --- End of Main Execution Block ---